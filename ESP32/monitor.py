@@ -1,10 +1,41 @@
+import math
+import os
+import re
+import queue
+import select
+import sys
+import threading
 import serial
 import serial.tools.list_ports
 import time
 import json
-import matplotlib.pyplot as plt
+import numpy as np
 from datetime import datetime
 
+try:
+    import orjson  # Optional: much faster JSON serialization in save_data
+except ImportError:
+    orjson = None
+
+# "RSSI: <int> dBm" optionally followed by "Distance: <float> m" on the same line.
+# The distance also matches what printf("%.2f") gives for bad values (-1.00, nan, -inf)
+POSITION_PATTERN = re.compile(rb"RSSI:\s*(-?\d+)\s*dBm(?:.*?Distance:\s*([-+]?(?:[\d.]+|nan|inf))\s*m)?")
+STATUS_PATTERN = re.compile(rb"Position report status:|Send Status:")
+
+# Path-loss distance (Tx power 0 dBm, n = 2) for every RSSI the radio can report (int8 dBm)
+RSSI_LUT_MIN = -128
+RSSI_LUT_MAX = 127
+RSSI_DISTANCE_LUT = np.power(10.0, (0 - np.arange(RSSI_LUT_MIN, RSSI_LUT_MAX + 1)) / 20.0)
+
+# Samples are stored column-wise; 'device' indexes into DEVICE_TYPES
+DEVICE_TYPES = ('coordinator', 'enddevice')
+POSITION_DTYPE = np.dtype([
+    ('timestamp', 'f8'),  # UNIX epoch seconds
+    ('device', 'u1'),
+    ('rssi', 'i1'),       # dBm, as reported by the radio (int8)
+    ('distance', 'f8'),   # meters
+])
+
 class ESPNowMonitor:
     def __init__(self, coordinator_port=None, enddevice_port=None, baudrate=115200):
         # Auto-detect COM ports if not specified
@@ -30,14 +61,28 @@ class ESPNowMonitor:
             self.print_troubleshooting()
             raise
         
-        self.position_data = []
+        # Preallocated sample buffer, grown 2x when full
+        self._samples = np.empty(4096, dtype=POSITION_DTYPE)
+        self._sample_count = 0
+        self._filled_count = 0  # Samples whose missing distances have been computed
+        self._raw_lines = []
+        
+        # Trailing partial line from the last bulk read of each port
+        self._leftovers = {device_type: b'' for device_type in DEVICE_TYPES}
+        
+        # Console output is handed to a printer thread while monitoring
+        self._output = queue.SimpleQueue()
+        self._printer = None
+        self._quiet = False
     
     def connect_with_retry(self, port, baudrate, device_name, max_retries=3):
         """Try to connect to serial port with retries"""
         for attempt in range(max_retries):
             try:
                 print(f"  Attempting to connect to {device_name} on {port} (attempt {attempt + 1}/{max_retries})")
-                return serial.Serial(port, baudrate, timeout=1)
+                connection = serial.Serial(port, baudrate, timeout=1)
+                self.set_low_latency(port)
+                return connection
             except serial.SerialException as e:
                 if "PermissionError" in str(e) or "Access is denied" in str(e):
                     print(f"  Access denied to {port}. This usually means:")
@@ -52,6 +97,15 @@ class ESPNowMonitor:
                 else:
                     raise e
     
+    def set_low_latency(self, port):
+        """Lower the USB-serial latency timer to 1 ms where the driver exposes it (Linux FTDI)"""
+        latency_path = f"/sys/bus/usb-serial/devices/{os.path.basename(port)}/latency_timer"
+        try:
+            with open(latency_path, 'w') as f:
+                f.write("1")
+        except OSError:
+            pass  # Not an FTDI adapter, not Linux, or no permission
+    
     def print_troubleshooting(self):
         """Print detailed troubleshooting information"""
         print("\n=== TROUBLESHOOTING ===")
@@ -74,111 +128,259 @@ class ESPNowMonitor:
         print(f"Available COM ports: {available}")
         return available
         
-    def monitor_communication(self, duration=60):
-        """Monitor ESP-NOW communication for specified duration in seconds"""
+    def monitor_communication(self, duration=60, quiet=False):
+        """Monitor ESP-NOW communication for specified duration in seconds (quiet=True skips echoing lines)"""
         start_time = time.time()
         
         print(f"\nMonitoring ESP-NOW communication for {duration} seconds...")
         print("Press Ctrl+C to stop monitoring early")
         print("=" * 50)
         
-        while time.time() - start_time < duration:
-            # Read from coordinator
-            if self.coord_serial and self.coord_serial.in_waiting:
-                try:
-                    coord_data = self.coord_serial.readline().decode().strip()
-                    if coord_data:  # Only print non-empty lines
-                        print(f"[COORD] {coord_data}")
-                        self.parse_position_data(coord_data, "coordinator")
-                except (UnicodeDecodeError, serial.SerialException):
-                    pass  # Skip malformed data or connection issues
+        deadline = start_time + duration
+        ports = [(self.coord_serial, "COORD", "coordinator"),
+                 (self.end_serial, "END", "enddevice")]
+        ports = [entry for entry in ports if entry[0]]
+        
+        # Block until a line arrives instead of polling in_waiting
+        self._quiet = quiet
+        self._start_printer()
+        try:
+            if os.name == 'posix':
+                self._monitor_select(ports, deadline)
+            else:
+                self._monitor_threaded(ports, deadline)
+        finally:
+            self._stop_printer()
+            self._quiet = False
+            self._fill_distances()
+        
+        print("=" * 50)
+        print(f"Monitoring complete. Collected {self._sample_count} position data points.")
+    
+    def _monitor_select(self, ports, deadline):
+        """Wait on the serial file descriptors with select() and read lines as they arrive (POSIX)"""
+        while ports:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
             
-            # Read from end device
-            if self.end_serial and self.end_serial.in_waiting:
+            ready, _, _ = select.select([port for port, _, _ in ports], [], [], remaining)
+            for entry in list(ports):
+                port, label, device_type = entry
+                if port not in ready:
+                    continue
                 try:
-                    end_data = self.end_serial.readline().decode().strip()
-                    if end_data:  # Only print non-empty lines
-                        print(f"[END] {end_data}")
-                        self.parse_position_data(end_data, "enddevice")
-                except (UnicodeDecodeError, serial.SerialException):
-                    pass  # Skip malformed data or connection issues
-            
-            time.sleep(0.1)
+                    for line in self._read_lines(port, device_type):
+                        self._handle_line(line, label, device_type)
+                except serial.SerialException:
+                    ports.remove(entry)  # Stop watching a port that went away
+    
+    def _monitor_threaded(self, ports, deadline):
+        """Read each port on its own thread and handle lines as they arrive (Windows)"""
+        lines = queue.SimpleQueue()
+        stop = threading.Event()
         
-        print("=" * 50)
-        print(f"Monitoring complete. Collected {len(self.position_data)} position data points.")
+        def reader(port, label, device_type):
+            while not stop.is_set():
+                try:
+                    for line in self._read_lines(port, device_type):
+                        lines.put((line, label, device_type))
+                except serial.SerialException:
+                    break  # Port went away
+        
+        threads = [threading.Thread(target=reader, args=entry, daemon=True) for entry in ports]
+        for thread in threads:
+            thread.start()
+        
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    # Short waits: on Windows a blocked lock wait ignores Ctrl+C
+                    line, label, device_type = lines.get(timeout=min(remaining, 0.5))
+                except queue.Empty:
+                    continue
+                self._handle_line(line, label, device_type)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+    
+    def _read_lines(self, port, device_type):
+        """Read all bytes waiting on the port in one call and return the complete lines in them"""
+        chunk = self._leftovers[device_type] + port.read(port.in_waiting or 1)
+        *lines, self._leftovers[device_type] = chunk.split(b'\n')
+        return lines
+    
+    def _handle_line(self, line, label, device_type):
+        """Echo and parse one raw line read from a serial port"""
+        line = line.strip()
+        if line:  # Only print non-empty lines
+            if not self._quiet:
+                self._emit(f"[{label}] {line.decode(errors='replace')}")
+            self.parse_position_data(line, device_type)
+    
+    def _emit(self, text):
+        """Queue a console line for the printer thread, or print it directly when none is running"""
+        if self._printer is None:
+            print(text)
+        else:
+            self._output.put(text)
+    
+    def _start_printer(self):
+        """Start a thread that writes queued console lines, batching whatever has piled up"""
+        def printer():
+            while True:
+                # Block until there is something to print, then drain the rest
+                batch = [self._output.get()]
+                while True:
+                    try:
+                        batch.append(self._output.get_nowait())
+                    except queue.Empty:
+                        break
+                
+                stopping = None in batch  # None is the stop sentinel
+                lines = [text for text in batch if text is not None]
+                if lines:
+                    sys.stdout.write("\n".join(lines) + "\n")
+                    sys.stdout.flush()
+                if stopping:
+                    break
+        
+        self._printer = threading.Thread(target=printer, daemon=True)
+        self._printer.start()
+    
+    def _stop_printer(self):
+        """Flush any queued console lines and stop the printer thread"""
+        self._output.put(None)
+        self._printer.join()
+        self._printer = None
     
     def parse_position_data(self, data, device_type):
-        """Parse RSSI and distance data from ESP-NOW serial output"""
+        """Parse RSSI and distance data from a raw ESP-NOW serial line (bytes)"""
+        if device_type not in DEVICE_TYPES:
+            raise ValueError(f"Unknown device type {device_type!r}, expected one of {DEVICE_TYPES}")
+        
         try:
-            # Look for different patterns in ESP-NOW output
-            if "RSSI:" in data and "dBm" in data:
-                # Extract RSSI value
-                rssi_start = data.find("RSSI:") + 5
-                rssi_end = data.find("dBm", rssi_start)
-                rssi = int(data[rssi_start:rssi_end].strip())
+            # Single regex pass over the raw bytes, no decoding needed
+            match = POSITION_PATTERN.search(data)
+            if match:
+                rssi = int(match.group(1))
+                if not RSSI_LUT_MIN <= rssi <= RSSI_LUT_MAX:
+                    raise ValueError(f"RSSI {rssi} dBm is outside the int8 range the radio reports")
                 
-                # Extract distance if present
-                distance = None
-                if "Distance:" in data:
-                    dist_start = data.find("Distance:") + 9
-                    dist_end = data.find("m", dist_start)
-                    distance = float(data[dist_start:dist_end].strip())
+                # Use reported distance if present (a negative or non-finite one makes
+                # the line malformed), otherwise it is calculated from RSSI later (see _fill_distances)
+                if match.group(2):
+                    distance = float(match.group(2))
+                    if not math.isfinite(distance) or distance < 0:
+                        raise ValueError(f"invalid distance: {distance}")
                 else:
-                    # Calculate distance from RSSI if not provided
-                    distance = self.rssi_to_distance(rssi)
+                    distance = np.nan
                 
-                position_entry = {
-                    'timestamp': datetime.now().isoformat(),
-                    'device': device_type,
-                    'rssi': rssi,
-                    'distance': distance,
-                    'raw_data': data
-                }
+                self._append_sample(device_type, rssi, distance, data)
                 
-                self.position_data.append(position_entry)
-                
-            elif "Position report status:" in data or "Send Status:" in data:
+            elif not self._quiet and STATUS_PATTERN.search(data):
                 # Log communication status
-                print(f"    -> {data}")
+                self._emit(f"    -> {data.decode(errors='replace')}")
                 
-        except (ValueError, IndexError) as e:
+        except ValueError:
             pass  # Skip malformed data
     
+    def _append_sample(self, device_type, rssi, distance, raw_data):
+        """Store one parsed sample in the columnar buffer"""
+        if self._sample_count == len(self._samples):
+            grown = np.empty(2 * len(self._samples), dtype=POSITION_DTYPE)
+            grown[:self._sample_count] = self._samples
+            self._samples = grown
+        
+        self._samples[self._sample_count] = (time.time(), DEVICE_TYPES.index(device_type), rssi, distance)
+        self._sample_count += 1
+        self._raw_lines.append(raw_data)
+    
+    @property
+    def position_data(self):
+        """Read-only structured array view of the samples (see POSITION_DTYPE); use to_records() for a list of dicts"""
+        samples = self._samples[:self._sample_count]
+        samples.setflags(write=False)
+        return samples
+    
+    def _fill_distances(self):
+        """Compute the distances devices didn't report, in one vectorized pass over samples added since the last call"""
+        pending = self._samples[self._filled_count:self._sample_count]
+        missing = np.isnan(pending['distance'])
+        if missing.any():
+            pending['distance'][missing] = self._rssi_to_distance_vec(pending['rssi'][missing])
+        self._filled_count = self._sample_count
+    
+    def to_records(self):
+        """Collected samples as a list of dicts, as written by save_data"""
+        self._fill_distances()
+        samples = self.position_data
+        return [
+            {
+                'timestamp': timestamp,
+                'device': DEVICE_TYPES[device],
+                'rssi': rssi,
+                'distance': distance,
+                'raw_data': raw_data.decode(errors='replace')
+            }
+            for timestamp, device, rssi, distance, raw_data in zip(
+                np.datetime_as_string(self._local_datetimes(samples['timestamp'])).tolist(),
+                samples['device'].tolist(),
+                samples['rssi'].tolist(),
+                samples['distance'].tolist(),
+                self._raw_lines)
+        ]
+    
     def rssi_to_distance(self, rssi):
-        """Calculate distance from RSSI using path loss formula"""
-        import math
-        return math.pow(10, (0 - rssi) / 20.0)
+        """Calculate distance from RSSI using path loss formula (table lookup, rounded to 1 dBm bins)"""
+        rssi = round(rssi)
+        if not RSSI_LUT_MIN <= rssi <= RSSI_LUT_MAX:
+            raise ValueError(f"RSSI {rssi} dBm is outside the int8 range the radio reports")
+        return float(RSSI_DISTANCE_LUT[rssi - RSSI_LUT_MIN])
+    
+    def _rssi_to_distance_vec(self, rssi):
+        """Vectorized rssi_to_distance for an int8 array of RSSI values (one table gather)"""
+        return RSSI_DISTANCE_LUT[np.asarray(rssi, dtype=np.intp) - RSSI_LUT_MIN]
+    
+    def _local_datetimes(self, timestamps):
+        """Convert an array of epoch seconds to local-time datetime64[us], honoring DST changes"""
+        # UTC offsets only change on quarter-hour boundaries, so one lookup per
+        # 15-minute bucket gives every sample the offset in effect when it was taken
+        buckets, bucket_index = np.unique(timestamps // 900, return_inverse=True)
+        utc_offsets = np.array([datetime.fromtimestamp(bucket * 900).astimezone().utcoffset().total_seconds()
+                                for bucket in buckets.tolist()])
+        return np.round((timestamps + utc_offsets[bucket_index]) * 1e6).astype('datetime64[us]')
     
     def plot_position_data(self):
         """Create plots of RSSI and distance over time"""
-        if not self.position_data:
+        if not self._sample_count:
             print("No position data to plot")
             return
         
-        # Separate data by device type
-        coord_data = [entry for entry in self.position_data if entry['device'] == 'coordinator']
-        end_data = [entry for entry in self.position_data if entry['device'] == 'enddevice']
+        import matplotlib.pyplot as plt  # Deferred: heavy import only needed for plotting
+        
+        self._fill_distances()
+        samples = self.position_data
+        times = self._local_datetimes(samples['timestamp'])
         
         fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 8))
         
-        # Plot coordinator data
-        if coord_data:
-            coord_times = [datetime.fromisoformat(entry['timestamp']) for entry in coord_data]
-            coord_rssi = [entry['rssi'] for entry in coord_data]
-            coord_dist = [entry['distance'] for entry in coord_data]
-            
-            ax1.plot(coord_times, coord_rssi, 'b-', marker='o', markersize=3, label='Coordinator')
-            ax2.plot(coord_times, coord_dist, 'b-', marker='o', markersize=3, label='Coordinator')
-        
-        # Plot end device data
-        if end_data:
-            end_times = [datetime.fromisoformat(entry['timestamp']) for entry in end_data]
-            end_rssi = [entry['rssi'] for entry in end_data]
-            end_dist = [entry['distance'] for entry in end_data]
+        # One boolean mask per device selects every column at once
+        device_styles = (('coordinator', 'b-', 'o', 'Coordinator'),
+                         ('enddevice', 'r-', 's', 'End Device'))
+        for device_type, style, marker, label in device_styles:
+            mask = samples['device'] == DEVICE_TYPES.index(device_type)
+            if not mask.any():
+                continue
             
-            ax1.plot(end_times, end_rssi, 'r-', marker='s', markersize=3, label='End Device')
-            ax2.plot(end_times, end_dist, 'r-', marker='s', markersize=3, label='End Device')
+            device_samples = samples[mask]
+            device_times = times[mask]
+            ax1.plot(device_times, device_samples['rssi'], style, marker=marker, markersize=3, label=label)
+            ax2.plot(device_times, device_samples['distance'], style, marker=marker, markersize=3, label=label)
         
         ax1.set_ylabel('RSSI (dBm)')
         ax1.set_title('ESP-NOW Communication Analysis')
@@ -196,8 +398,13 @@ class ESPNowMonitor:
     
     def save_data(self, filename="esp_now_data.json"):
         """Save collected data to JSON file"""
-        with open(filename, 'w') as f:
-            json.dump(self.position_data, f, indent=2)
+        # Both serializers write the same indented UTF-8 layout
+        if orjson is not None:
+            with open(filename, 'wb') as f:
+                f.write(orjson.dumps(self.to_records(), option=orjson.OPT_INDENT_2))
+        else:
+            with open(filename, 'w', encoding='utf-8') as f:
+                json.dump(self.to_records(), f, indent=2, ensure_ascii=False)
         print(f"Data saved to {filename}")
     
     def close(self):
@@ -217,7 +424,8 @@ if __name__ == "__main__":
         monitor = ESPNowMonitor()  # Will auto-detect ports
         # monitor = ESPNowMonitor("COM3", "COM7")  # Manual specification
         
-        monitor.monitor_communication(duration=60)  # Monitor for 1 minute
+        quiet = "--quiet" in sys.argv[1:]  # Skip echoing serial lines for maximum throughput
+        monitor.monitor_communication(duration=60, quiet=quiet)  # Monitor for 1 minute
         monitor.plot_position_data()
         monitor.save_data()
     except KeyboardInterrupt: